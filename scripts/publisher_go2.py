@@ -14,12 +14,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import array
+
 import rclpy
 from rclpy.node import Node
 
 from ros_interface_mpc.msg import Torque, State
 from sensor_msgs.msg import Joy
-from rclpy.qos import QoSProfile
+from rclpy.qos import QoSProfile, ReliabilityPolicy, HistoryPolicy
 
 import numpy as np
 
@@ -59,11 +61,16 @@ class MpcPublisher(Node):
         self.commanded_vel = np.zeros(6)
         self.walking = False
 
+        # robot_states is published best-effort by the simulation node
+        sensor_qos = QoSProfile(
+            reliability=ReliabilityPolicy.BEST_EFFORT,
+            history=HistoryPolicy.KEEP_LAST,
+            depth=1)
         self.subscription = self.create_subscription(
             State,
             'robot_states',
             self.listener_callback,
-            1)
+            sensor_qos)
         self.subscription  # prevent unused variable warning
 
         self.subinput = self.create_subscription(
@@ -105,13 +112,11 @@ class MpcPublisher(Node):
         self.mpc_block.update_mpc(self.x0)
         msg = Torque()
         if self.parameter.value == "fulldynamics":
-            msg.x0 = self.x0.tolist()
-            msg.u0 = self.mpc_block.mpc.us[0].tolist()
-            K0 = self.mpc_block.mpc.K0.tolist()
-            riccati = []
-            for k in K0:
-                riccati += k
-            msg.riccati = riccati
+            # float64[] fields are array.array('d'), fill them from raw bytes;
+            # riccati holds K0 flattened row by row
+            msg.x0 = array.array('d', self.x0.tobytes())
+            msg.u0 = array.array('d', self.mpc_block.mpc.us[0].tobytes())
+            msg.riccati = array.array('d', self.mpc_block.mpc.K0.tobytes(order='C'))
             msg.ndx = self.ndx
             msg.nu = self.nu
         elif self.parameter.value == "kinodynamics":
@@ -14,16 +14,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import array
+import os
+import sys
+import threading
+import time
+
 import rclpy
 from rclpy.node import Node
+from rclpy.callback_groups import MutuallyExclusiveCallbackGroup
+from rclpy.executors import MultiThreadedExecutor
 import numpy as np
 
 import pinocchio as pin
 from ros_interface_mpc.msg import Torque, RobotState
 from sensor_msgs.msg import JointState
 from tf2_ros import TransformBroadcaster, TransformStamped
-from geometry_msgs.msg import Quaternion
-from rclpy.qos import QoSProfile
+from rclpy.qos import QoSProfile, ReliabilityPolicy, HistoryPolicy
 from simple_mpc import IDSolver
 
 from simulation_args import SimulationArgs
@@ -62,14 +69,18 @@ class SimulationWrapper():
         removeBVHModelsIfAny(geom_model)
         addSystemCollisionPairs(self.rmodel, geom_model, q0)
 
-        # Remove all pair of collision which does not concern floor collision
-        i = 0
-        while i < len(geom_model.collisionPairs):
-            cp = geom_model.collisionPairs[i]
-            if geom_model.geometryObjects[cp.first].name != 'floor' and geom_model.geometryObjects[cp.second].name != 'floor':
-                geom_model.removeCollisionPair(cp)
-            else:
-                i = i + 1
+        # Remove all pair of collision which does not concern floor collision.
+        # Pairs are filtered in one pass and the kept ones re-added, rather
+        # than removed one by one from the pair vector.
+        names = [gobj.name for gobj in geom_model.geometryObjects]
+        floor_pairs = [
+            pin.CollisionPair(cp.first, cp.second)
+            for cp in geom_model.collisionPairs
+            if names[cp.first] == 'floor' or names[cp.second] == 'floor'
+        ]
+        geom_model.removeAllCollisionPairs()
+        for cp in floor_pairs:
+            geom_model.addCollisionPair(cp)
         
         # Create the simulator object
         self.simulator = Simulation(self.rmodel, geom_model, visual_model, q0, v0, args) 
@@ -83,41 +94,72 @@ class MpcSubscriber(Node):
         super().__init__('mpc_subscriber')
         self.declare_parameter('mpc_type')
         self.parameter = self.get_parameter('mpc_type')
+        # The MPC type is fixed for the node lifetime, read it once
+        self._mpc_mode = self.parameter.value
+        # CPU (isolated with isolcpus) and SCHED_FIFO priority requested for
+        # the simulation thread, -1 leaves the default scheduling
+        self.declare_parameter('control_cpu', -1)
+        self.declare_parameter('control_priority', -1)
         self.start_mpc = False
+
+        # Separate callback groups so that command reception and state
+        # publishing can run concurrently on a multi-threaded executor
+        self.cb_ctrl = MutuallyExclusiveCallbackGroup()
+        self.cb_sub = MutuallyExclusiveCallbackGroup()
         
-        # Define state publisher
+        # Define state publisher. Streamed states and commands only matter
+        # through their latest sample, so they are sent best-effort.
+        # TF keeps the reliable profile expected by tf2 listeners.
         qos_profile = QoSProfile(depth=10)
-        self.joint_pub = self.create_publisher(JointState, 'joint_states', qos_profile)
-        self.robot_pub = self.create_publisher(RobotState, 'robot_states', 10)
+        sensor_qos = QoSProfile(
+            reliability=ReliabilityPolicy.BEST_EFFORT,
+            history=HistoryPolicy.KEEP_LAST,
+            depth=1)
+        self.joint_pub = self.create_publisher(JointState, 'joint_states', sensor_qos)
+        self.robot_pub = self.create_publisher(RobotState, 'robot_states', sensor_qos)
         self.broadcaster = TransformBroadcaster(self, qos=qos_profile)
         
-        # Define command subscriber
+        # Define command subscriber, with a depth of 1 a stale command is
+        # dropped instead of being queued behind the latest one
         self.subscription = self.create_subscription(
             Torque,
             'command',
             self.listener_callback,
-            qos_profile)
-        self.subscription  # prevent unused variable warning
+            sensor_qos,
+            callback_group=self.cb_sub)
+
+        # Define at which rate the simulation state is sent to the MPC and TF
+        timer_period = 0.005  # seconds
+        self.timer = self.create_timer(
+            timer_period, self._publish_step, callback_group=self.cb_ctrl)
 
-        # Define at which rate the simulation state is sent to rviz
-        timer_period = 0.001  # seconds
-        self.timer = self.create_timer(timer_period, self.timer_callback)
+        # Joint states only feed robot_state_publisher for rviz display
+        joint_timer_period = 1.0 / 30  # seconds
+        self.joint_timer = self.create_timer(
+            joint_timer_period, self._publish_joint_step, callback_group=self.cb_ctrl)
+
+        # Define at which rate the simulation is stepped, outside of the executor
+        self.sim_period = 0.001  # seconds
+        self.lock = threading.Lock()
+        self._stop_sim = threading.Event()
+        self._latest_cmd = None
 
         # Message declarations for odometry
         self.odom_trans = TransformStamped()
         self.odom_trans.header.frame_id = 'world'
         self.odom_trans.child_frame_id = 'base'
         self.robot_state = RobotState()
-        
-        # Message declarations for torque
-        self.wrapper = SimulationWrapper()
-        self.ndx = self.wrapper.rmodel.nv * 2
-        self.nq = self.wrapper.rmodel.nq
-        self.nu = self.wrapper.rmodel.nv - 6
-        self.torque_simu = np.zeros(self.wrapper.rmodel.nv)
-        self.current_torque = np.zeros(self.wrapper.rmodel.nv - 6)
-        self.space = manifolds.MultibodyPhaseSpace(self.wrapper.rmodel)
 
+        # The base transform is re-sent only when the base pose moved by more
+        # than tf_tolerance, or after tf_keepalive seconds. The keepalive is
+        # measured in wall-clock (monotonic) time, not with the node clock
+        # used for the TF stamp.
+        self.tf_tolerance = 1e-5
+        self.tf_keepalive = 0.05  # seconds
+        self._last_pub_xyzq = np.zeros(7)
+        self._xyzq_delta = np.empty(7)
+        self._last_tf_time = 0.0
+        
         # Message declaration for joint states
         self.measure = JointState()
         self.measure.name = ["FL_hip_joint",
@@ -133,27 +175,74 @@ class MpcSubscriber(Node):
             "RR_thigh_joint",
             "RR_calf_joint"
         ]
-        self.measure.position = [0., 0., 0., # FL
-                                 0., 0., 0., # FR
-                                 0., 0., 0., # HL
-                                 0., 0., 0., # HR
-        ]
-        self.robot_state.position = self.measure.position
-        self.measure.velocity = [0., 0., 0., # FL
-                                 0., 0., 0., # FR
-                                 0., 0., 0., # HL
-                                 0., 0., 0., # HR
-        ]
-        self.robot_state.velocity = self.measure.velocity
+        # The simulator is slow to build, do it in the background so that the
+        # node shows up in the ROS graph right away. Callbacks are gated on
+        # self._ready until it is done.
+        self.wrapper = None
+        self._ready = threading.Event()
+        self.failed = False
+        self.sim_thread = threading.Thread(target=self._sim_loop, daemon=True)
+        threading.Thread(target=self._build_wrapper, daemon=True).start()
+
+    def _build_wrapper(self):
+        # Any failure, including the SystemExit raised by exit() in the
+        # simulation setup, would only end this thread. Report it and shut
+        # the node down instead of spinning without a simulator.
+        try:
+            self._build_simulation()
+        except BaseException as e:
+            self._abort('Failed to build the simulation', e)
+            return
+
+        # Start the physics loop once everything it reads is built
+        self._ready.set()
+        if not self._stop_sim.is_set():
+            self.sim_thread.start()
+
+    def _build_simulation(self):
+        # Simulator and message declarations for torque
+        self.wrapper = SimulationWrapper()
+        self.ndx = self.wrapper.rmodel.nv * 2
+        self.nq = self.wrapper.rmodel.nq
+        self.nu = self.wrapper.rmodel.nv - 6
+        self.torque_simu = np.zeros(self.wrapper.rmodel.nv)
+        # Joint torques are computed directly into the simulator input
+        self.current_torque = self.torque_simu[6:]
+        self.space = manifolds.MultibodyPhaseSpace(self.wrapper.rmodel)
+
+        # Work buffers for the torque laws, filled in place at each step
+        self._x_measured = np.empty(self.nq + self.wrapper.rmodel.nv)
+        self._dx = np.empty(self.ndx)
+        self._tmp_tau = np.empty(self.nu)
+
         self.controlled_joint_ids = [0, 1, 2,
                                      3, 4, 5,
                                      6, 7, 8,
                                      9, 10, 11, 
         ]
+        # Joints are measured in model order, so messages are filled by slicing
+        assert self.controlled_joint_ids == list(range(self.nu))
+
+        # float64[] fields are backed by array.array('d'), keep writable
+        # NumPy views on them to copy joint measures in bulk. Each message
+        # owns its buffers since both are published at different rates.
+        self._pos_buf = array.array('d', [0.0] * self.nu)
+        self._vel_buf = array.array('d', [0.0] * self.nu)
+        self._pos_view = np.frombuffer(self._pos_buf, dtype=np.float64)
+        self._vel_view = np.frombuffer(self._vel_buf, dtype=np.float64)
+        self.robot_state.position = self._pos_buf
+        self.robot_state.velocity = self._vel_buf
+        self._joint_pos_buf = array.array('d', [0.0] * self.nu)
+        self._joint_vel_buf = array.array('d', [0.0] * self.nu)
+        self._joint_pos_view = np.frombuffer(self._joint_pos_buf, dtype=np.float64)
+        self._joint_vel_view = np.frombuffer(self._joint_vel_buf, dtype=np.float64)
+        self.measure.position = self._joint_pos_buf
+        self.measure.velocity = self._joint_vel_buf
         
         # Initial state of the robot with feedforward torque equal to
         # gravity-compensating torque in half-sitting
         q_current, v_current = self.wrapper.simulator.get_state()
+        self.q_current, self.v_current = q_current, v_current
     
         self.x0 = np.concatenate((q_current, v_current))
         self.u0 = np.array([-3.71, -1.81,  5.25,  
@@ -166,18 +255,20 @@ class MpcSubscriber(Node):
         self.set_messages(q_current, v_current)
         
         # Define default PD controller that runs before MPC launch
+        # Gains are diagonal, store them as vectors and apply them elementwise
         gain = 100
-        self.Kp = np.identity(self.nu) * gain
-        self.Kd = np.identity(self.nu) * 1
+        self.kp_diag = np.full(self.nu, float(gain))
+        self.kd_diag = np.ones(self.nu)
 
         # Build whole-body control layer depending on the
         # type of MPC in use
         self.WB_solver = None
 
-        if self.parameter.value == "kinodynamics":
+        if self._mpc_mode == "kinodynamics":
             self.handler = loadHandlerGo2()
             
             contact_ids = self.handler.getFeetIds()
+            self._n_contacts = len(contact_ids)
             id_conf = dict(
                 contact_ids=contact_ids,
                 x0=self.handler.getState(),
@@ -193,93 +284,236 @@ class MpcSubscriber(Node):
 
             self.WB_solver = IDSolver()
             self.WB_solver.initialize(id_conf, self.handler.getModel())
-            
+
+        # Select the MPC tracking law once, the PD law is kept for unknown types
+        self._mpc_step = {
+            "fulldynamics": self._fulldyn_step,
+            "kinodynamics": self._kinodyn_step,
+        }.get(self._mpc_mode, self._pd_step)
 
     def listener_callback(self, msg):
         #self.get_logger().info('I heard: "%s"' % msg.x0[0])
-        
-        if self.parameter.value == "fulldynamics":
-            self.u0 = np.array(msg.u0.tolist())
-            self.x0 = np.array(msg.x0.tolist())
-            self.K0 = np.array(msg.riccati.tolist()).reshape((self.nu, self.ndx))
-        elif self.parameter.value == "kinodynamics":
+        if not self._ready.is_set():
+            return
+
+        # Single-slot mailbox: a newer command overwrites one that the
+        # simulation thread has not taken yet
+        with self.lock:
+            self._latest_cmd = msg
+
+    def _command_size_ok(self, msg):
+        # Sizes expected by the control laws; a command built for another
+        # robot would otherwise fail inside the simulation thread
+        nv = self.wrapper.rmodel.nv
+        if self._mpc_mode == "fulldynamics":
+            return (len(msg.u0) == self.nu
+                    and len(msg.x0) == self.nq + nv
+                    and len(msg.riccati) == self.nu * self.ndx)
+        elif self._mpc_mode == "kinodynamics":
+            return (len(msg.contact_states) == self._n_contacts
+                    and len(msg.forces) == 3 * self._n_contacts
+                    and len(msg.a0) == nv)
+        return True
+
+    def _apply_command(self, msg):
+        if not self._command_size_ok(msg):
+            self.get_logger().warn(
+                'Dropping command with unexpected sizes for %s' % self._mpc_mode,
+                throttle_duration_sec=1.0)
+            return
+        if self._mpc_mode == "fulldynamics":
+            # float64[] fields are array.array('d'), view them without copy
+            self.u0 = np.asarray(msg.u0, dtype=np.float64)
+            self.x0 = np.asarray(msg.x0, dtype=np.float64)
+            self.K0 = np.frombuffer(memoryview(msg.riccati), dtype=np.float64).reshape((self.nu, self.ndx))
+            self.start_mpc = True
+        elif self._mpc_mode == "kinodynamics":
+            # contact_states is a bool[] field, i.e. a plain Python list that
+            # the solver binding takes as is
             self.contact_states = msg.contact_states
-            self.forces = np.array(msg.forces)
-            self.a0 = np.array(msg.a0)
+            self.forces = np.frombuffer(memoryview(msg.forces), dtype=np.float64)
+            self.a0 = np.frombuffer(memoryview(msg.a0), dtype=np.float64)
+            self.start_mpc = True
 
-        self.start_mpc = True
-    
-    def timer_callback(self):
-        q_current, v_current = self.wrapper.simulator.get_state()
-        
-        if not(self.start_mpc):
-            self.current_torque = self.u0 - self.Kp @ (q_current[7:] - self.x0[7:self.nq]) - self.Kd @ v_current[6:]
+    def _set_realtime(self):
+        # Applies to the calling thread only, and only when requested through
+        # the parameters. Both calls may be refused (missing CAP_SYS_NICE,
+        # CPU not available), the loop then runs with default scheduling.
+        tid = threading.get_native_id()
+        cpu = self.get_parameter('control_cpu').value
+        priority = self.get_parameter('control_priority').value
+        if cpu >= 0:
+            try:
+                os.sched_setaffinity(tid, {cpu})
+            except OSError as e:
+                self.get_logger().warn('Cannot pin control thread on CPU %d: %s' % (cpu, e))
+        if priority >= 0:
+            try:
+                os.sched_setscheduler(tid, os.SCHED_FIFO, os.sched_param(priority))
+            except OSError as e:
+                self.get_logger().warn('Cannot set SCHED_FIFO priority %d: %s' % (priority, e))
+
+    def _abort(self, what, e):
+        # Called from a background thread, where an exception would only end
+        # that thread. Stop the whole node so that main() exits with an error.
+        self.get_logger().fatal('%s: %r' % (what, e))
+        self.failed = True
+        rclpy.try_shutdown()
+
+    def _sim_loop(self):
+        # A failing step must not leave the node publishing a frozen state
+        try:
+            self._set_realtime()
+            next_tick = time.monotonic()
+            while rclpy.ok() and not self._stop_sim.is_set():
+                self._sim_step()
+                next_tick += self.sim_period
+                delay = next_tick - time.monotonic()
+                if delay > 0:
+                    self._stop_sim.wait(delay)
+                else:
+                    # Overrun: restart pacing from now instead of bursting to catch up
+                    next_tick = time.monotonic()
+        except BaseException as e:
+            self._abort('Simulation step failed', e)
+
+    def _sim_step(self):
+        simulator = self.wrapper.simulator
+        # The state left by the previous step, only written by this thread
+        q_current, v_current = self.q_current, self.v_current
+
+        # Take the latest command, if any, and decode it in this thread
+        with self.lock:
+            msg = self._latest_cmd
+            self._latest_cmd = None
+        if msg is not None:
+            self._apply_command(msg)
+
+        if self.start_mpc:
+            self._mpc_step(q_current, v_current)
         else:
-            if self.parameter.value == "fulldynamics":
-                x_measured = np.concatenate((q_current, v_current))
-                self.current_torque = self.u0 - self.K0 @ self.space.difference(x_measured, self.x0)
-            elif self.parameter.value == "kinodynamics":
-                self.handler.updateState(q_current, v_current, True)
-                self.WB_solver.solve_qp(
-                    self.handler.getData(),
-                    self.contact_states,
-                    v_current,
-                    self.a0,
-                    self.forces,
-                    self.handler.getMassMatrix(),
-                )
-                self.current_torque = self.WB_solver.solved_torque
-        self.torque_simu[6:] = self.current_torque
-        self.wrapper.simulator.execute(self.torque_simu)
+            self._pd_step(q_current, v_current)
+        simulator.execute(self.torque_simu)
+
+        # Simulator returns fresh arrays at each step, sharing them is safe
+        q_current, v_current = simulator.get_state()
+        with self.lock:
+            self.q_current, self.v_current = q_current, v_current
+
+    # Control laws, each one writes the joint torque into current_torque.
+    # The command they read is only written by this thread.
+
+    def _pd_step(self, q_current, v_current):
+        # tau = u0 - kp * (q - q_ref) - kd * v
+        tau = self.current_torque
+        tmp = self._tmp_tau
+        np.subtract(q_current[7:], self.x0[7:self.nq], out=tau)
+        tau *= self.kp_diag
+        np.multiply(v_current[6:], self.kd_diag, out=tmp)
+        tau += tmp
+        np.subtract(self.u0, tau, out=tau)
+
+    def _fulldyn_step(self, q_current, v_current):
+        nq = self.nq
+        x_measured = self._x_measured
+        dx = self._dx
+        x_measured[:nq] = q_current
+        x_measured[nq:] = v_current
+        self.space.difference(x_measured, self.x0, dx)
+        # tau = u0 - K0 @ dx
+        tau = self.current_torque
+        np.dot(self.K0, dx, out=tau)
+        np.subtract(self.u0, tau, out=tau)
+
+    def _kinodyn_step(self, q_current, v_current):
+        handler = self.handler
+        handler.updateState(q_current, v_current, True)
+        self.WB_solver.solve_qp(
+            handler.getData(),
+            self.contact_states,
+            v_current,
+            self.a0,
+            self.forces,
+            handler.getMassMatrix(),
+        )
+        np.copyto(self.current_torque, self.WB_solver.solved_torque)
+
+    def _publish_step(self):
+        if not self._ready.is_set():
+            return
+        with self.lock:
+            q_current, v_current = self.q_current, self.v_current
 
         self.set_messages(q_current, v_current)
-        self.joint_pub.publish(self.measure)
         self.robot_pub.publish(self.robot_state)
-        self.broadcaster.sendTransform(self.odom_trans)
+
+        # Base pose change since the last broadcast, without temporaries
+        delta = self._xyzq_delta
+        np.subtract(q_current[:7], self._last_pub_xyzq, out=delta)
+        np.abs(delta, out=delta)
+        now = time.monotonic()
+        if delta.max() >= self.tf_tolerance or now - self._last_tf_time >= self.tf_keepalive:
+            self._last_pub_xyzq[:] = q_current[:7]
+            self._last_tf_time = now
+            self.broadcaster.sendTransform(self.odom_trans)
         #self.get_logger().info('Publishing: "%s"' % q_current)
+
+    def _publish_joint_step(self):
+        if not self._ready.is_set():
+            return
+        with self.lock:
+            q_current, v_current = self.q_current, self.v_current
+
+        self.measure.header.stamp = self.get_clock().now().to_msg()
+        self._joint_pos_view[:] = q_current[7:]
+        self._joint_vel_view[:] = v_current[6:]
+        self.joint_pub.publish(self.measure)
     
     def set_messages(self, q_current, v_current):
-        self.measure.header.stamp = self.get_clock().now().to_msg()
-        for meas_id, joint_id in enumerate(self.controlled_joint_ids):
-            self.measure.position[joint_id] = q_current[7 + meas_id]
-            self.measure.velocity[joint_id] = v_current[6 + meas_id]
-            self.robot_state.position[joint_id] = q_current[7 + meas_id]
-            self.robot_state.velocity[joint_id] = v_current[6 + meas_id]
-
-        self.odom_trans.header.stamp = self.get_clock().now().to_msg()
-        self.odom_trans.transform.translation.x = q_current[0]
-        self.odom_trans.transform.translation.y = q_current[1]
-        self.odom_trans.transform.translation.z = q_current[2]
-        self.odom_trans.transform.rotation = Quaternion(x=q_current[3], 
-                                                        y=q_current[4], 
-                                                        z=q_current[5], 
-                                                        w=q_current[6])
-        self.robot_state.transform.translation.x = q_current[0]
-        self.robot_state.transform.translation.y = q_current[1]
-        self.robot_state.transform.translation.z = q_current[2]
-        self.robot_state.transform.rotation = Quaternion(x=q_current[3], 
-                                                         y=q_current[4], 
-                                                         z=q_current[5], 
-                                                         w=q_current[6])
-        self.robot_state.twist.linear.x = v_current[0]
-        self.robot_state.twist.linear.y = v_current[1]
-        self.robot_state.twist.linear.z = v_current[2]
-        self.robot_state.twist.angular.x = v_current[3]
-        self.robot_state.twist.angular.y = v_current[4]
-        self.robot_state.twist.angular.z = v_current[5]
+        robot_state = self.robot_state
+        odom_trans = self.odom_trans
+        stamp = self.get_clock().now().to_msg()
+        robot_state.header.stamp = stamp
+        odom_trans.header.stamp = stamp
+        self._pos_view[:] = q_current[7:]
+        self._vel_view[:] = v_current[6:]
+
+        translation = odom_trans.transform.translation
+        translation.x, translation.y, translation.z = q_current[0:3]
+        rotation = odom_trans.transform.rotation
+        rotation.x, rotation.y, rotation.z, rotation.w = q_current[3:7]
+        translation = robot_state.transform.translation
+        translation.x, translation.y, translation.z = q_current[0:3]
+        rotation = robot_state.transform.rotation
+        rotation.x, rotation.y, rotation.z, rotation.w = q_current[3:7]
+        linear = robot_state.twist.linear
+        linear.x, linear.y, linear.z = v_current[0:3]
+        angular = robot_state.twist.angular
+        angular.x, angular.y, angular.z = v_current[3:6]
+
+    def destroy_node(self):
+        self._stop_sim.set()
+        if self.sim_thread.is_alive():
+            self.sim_thread.join()
+        super().destroy_node()
 
 def main(args=None):
     rclpy.init(args=args)
 
     mpc_subscriber = MpcSubscriber()
 
-    rclpy.spin(mpc_subscriber)
+    executor = MultiThreadedExecutor(num_threads=2)
+    executor.add_node(mpc_subscriber)
+    executor.spin()
 
     # Destroy the node explicitly
     # (optional - otherwise it will be done automatically
     # when the garbage collector destroys the node object)
     mpc_subscriber.destroy_node()
-    rclpy.shutdown()
+    # The context is already shut down if the simulation failed
+    rclpy.try_shutdown()
+    if mpc_subscriber.failed:
+        sys.exit(1)
 
 
 if __name__ == '__main__':